@@ -36,36 +36,147 @@ print("🚗 Starting Line Following with Path Recording...")
 current_left_pwm = 0
 current_right_pwm = 0
 base_speed = 80
-turn_speed = 50
+max_pwm = 255
 run_flag = True
 
 imu_data = [0, 0, 0]  # gx, gy, gz
 
+# ======== CONTROL CONFIG ========
+CONTROL_HZ = 100            # Fixed control loop rate (independent of camera FPS)
+KP = 60.0                   # PWM per unit of normalised line offset
+KI = 0.0
+KD = 4.0
+D_FILTER = 0.3              # Low-pass weight of the newest per-frame derivative
+INTEGRAL_LIMIT = 0.5        # Anti-windup clamp on the integral term
+GZ_SCALE = 131.0            # MPU6050 raw LSB per deg/s (+-250 dps range)
+OFFSET_PER_DEG = 0.01       # Image offset shift per degree of yaw
+MAX_EXTRAPOLATION = 0.1     # Seconds of gz extrapolation past the last frame
+LINE_TIMEOUT = 0.3          # Stop if no line seen for this long
+MIN_SEND_INTERVAL = 0.02    # Serial rate limit (9600 baud ~ 10 ms per command)
+KEEPALIVE_INTERVAL = 0.2    # Resend unchanged command this often
+
+# Latest vision measurement, shared with the control thread
+line_offset = 0.0           # -1 (far left) .. +1 (far right)
+line_time = 0.0             # time.monotonic() of the last frame the line was seen in
+line_seen = False           # Set once the line has been seen at least once
+state_lock = threading.Lock()
+serial_lock = threading.Lock()
+
 # ======== THREAD: READ IMU DATA CONTINUOUSLY ========
 def read_imu():
     global imu_data, run_flag
     while run_flag:
-        if ser.in_waiting:
-            line = ser.readline().decode().strip()
-            if line.startswith("IMU:"):
-                try:
-                    gx, gy, gz = map(int, line[4:].split(","))
-                    imu_data = [gx, gy, gz]
-                except:
-                    pass
+        # Blocking read (serial timeout=1) instead of polling in_waiting,
+        # so this thread doesn't hog the GIL from the control loop
+        line = ser.readline().decode(errors="ignore").strip()
+        if line.startswith("IMU:"):
+            try:
+                gx, gy, gz = map(int, line[4:].split(","))
+                imu_data = [gx, gy, gz]
+            except:
+                pass
 
 imu_thread = threading.Thread(target=read_imu, daemon=True)
 imu_thread.start()
 
+# ======== RATE-LIMITED SERIAL OUTPUT ========
+last_sent = None
+last_send_time = 0.0
+
+def send_command(cmd):
+    """Write cmd to the ESP32, skipping repeats and capping the send rate.
+
+    Commands inside MIN_SEND_INTERVAL are dropped, not queued. The control
+    loop calls this every tick, so the next write after the interval is
+    always its newest output.
+    """
+    global last_sent, last_send_time
+    now = time.monotonic()
+    with serial_lock:
+        if now - last_send_time < MIN_SEND_INTERVAL:
+            return
+        if cmd == last_sent and now - last_send_time < KEEPALIVE_INTERVAL:
+            return
+        ser.write(f"{cmd}\n".encode())
+        last_sent = cmd
+        last_send_time = now
+
+# ======== THREAD: FIXED-RATE PID CONTROL ========
+def control_loop():
+    global current_left_pwm, current_right_pwm
+    period = 1.0 / CONTROL_HZ
+    integral = 0.0
+    derivative = 0.0
+    prev_offset = None
+    prev_frame_time = None
+    last_tick = time.monotonic()
+    next_tick = last_tick
+
+    while run_flag:
+        now = time.monotonic()
+        dt = now - last_tick
+        last_tick = now
+        with state_lock:
+            offset, t_frame, seen = line_offset, line_time, line_seen
+
+        if not seen or now - t_frame > LINE_TIMEOUT:
+            # No line for LINE_TIMEOUT: stop and reset controller state.
+            # Shorter dropouts keep steering from the last offset below.
+            integral = 0.0
+            derivative = 0.0
+            prev_offset = None
+            prev_frame_time = None
+            current_left_pwm = 0
+            current_right_pwm = 0
+            send_command("S")
+        else:
+            # Extrapolate the offset between frames using the yaw rate.
+            # Turning left (positive gz) moves the line right in the image.
+            gz_dps = imu_data[2] / GZ_SCALE
+            dt_frame = min(now - t_frame, MAX_EXTRAPOLATION)
+            error = offset + OFFSET_PER_DEG * gz_dps * dt_frame
+            error = max(-1.0, min(1.0, error))
+
+            # The measured offset only changes once per frame, so differentiate
+            # over the real frame interval and hold the filtered value between.
+            if t_frame != prev_frame_time:
+                if prev_offset is not None and t_frame > prev_frame_time:
+                    raw = (offset - prev_offset) / (t_frame - prev_frame_time)
+                    derivative += D_FILTER * (raw - derivative)
+                prev_offset = offset
+                prev_frame_time = t_frame
+
+            integral += error * dt
+            integral = max(-INTEGRAL_LIMIT, min(INTEGRAL_LIMIT, integral))
+            correction = KP * error + KI * integral + KD * derivative
+
+            # Line to the right (error > 0) -> speed up left wheel
+            left = int(max(0, min(max_pwm, base_speed + correction)))
+            right = int(max(0, min(max_pwm, base_speed - correction)))
+            current_left_pwm = left
+            current_right_pwm = right
+            send_command(f"A{left}B{right}")
+
+        next_tick += period
+        sleep_time = next_tick - time.monotonic()
+        if sleep_time > 0:
+            time.sleep(sleep_time)
+        else:
+            next_tick = time.monotonic()  # Overran; resync instead of bursting
+
+control_thread = threading.Thread(target=control_loop, daemon=True)
+control_thread.start()
+
 # ======== CSV LOGGING ========
 csv_file = open("path_log.csv", "w", newline="")
 csv_writer = csv.writer(csv_file)
 csv_writer.writerow(["time", "gx", "gy", "gz", "leftPWM", "rightPWM"])
 
-# ======== MAIN LOOP ========
+# ======== MAIN LOOP (VISION ONLY) ========
 try:
     while True:
         ret, frame = cap.read()
+        frame_time = time.monotonic()  # Capture time, before processing latency
         if not ret:
             print("⚠️ Camera read failed")
             break
@@ -85,35 +196,16 @@ try:
             if M["m00"] > 0:
                 cx = int(M["m10"] / M["m00"])
 
+                # Publish normalised offset for the control thread
+                with state_lock:
+                    line_offset = (cx - width / 2) / (width / 2)
+                    line_time = frame_time
+                    line_seen = True
+
                 # Draw single visual indicator line
                 cv2.line(roi, (cx, 0), (cx, roi.shape[0]), (0, 255, 0), 2)
-
-                if cx < width / 3:
-                    # LEFT
-                    current_left_pwm = turn_speed
-                    current_right_pwm = base_speed
-                    ser.write(f"A{turn_speed}B{base_speed}\n".encode())
-                    cv2.putText(roi, "LEFT", (20, 30),
-                                cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
-
-                elif cx > 2 * width / 3:
-                    # RIGHT
-                    current_left_pwm = base_speed
-                    current_right_pwm = turn_speed
-                    ser.write(f"A{base_speed}B{turn_speed}\n".encode())
-                    cv2.putText(roi, "RIGHT", (20, 30),
-                                cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
-                else:
-                    # FORWARD
-                    current_left_pwm = base_speed
-                    current_right_pwm = base_speed
-                    ser.write(f"A{base_speed}B{base_speed}\n".encode())
-                    cv2.putText(roi, "FORWARD", (20, 30),
-                                cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
-            else:
-                ser.write(b"S\n")
-        else:
-            ser.write(b"S\n")
+                cv2.putText(roi, f"L{current_left_pwm} R{current_right_pwm}", (20, 30),
+                            cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
 
         # ======== LOG CURRENT STATE ========
         timestamp = time.time()
@@ -131,8 +223,10 @@ except KeyboardInterrupt:
 
 # ======== CLEANUP ========
 run_flag = False
+control_thread.join(timeout=1)
 csv_file.close()
-ser.write(b"S\n")
+with serial_lock:
+    ser.write(b"S\n")
 cap.release()
 cv2.destroyAllWindows()
 print("✅ Path recording stopped and saved as path_log.csv")